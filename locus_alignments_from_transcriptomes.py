@@ -32,28 +32,74 @@ Cymon J. Cox - 6-1-2022
 
 import os
 import sys
+import mmap
 import shutil
 import argparse
 import textwrap
 import subprocess
-from Bio import SeqIO
-
-def parse_input_file(input_file):
-    """Read the items from the input file"""
+from collections import Counter
+
+def index_fasta(path):
+    """Scan a fasta file for record byte offsets with mmap.
+
+    The record format here is known-simple (\">identifier|locus\" then
+    sequence lines), so a C-level scan for \"\\n>\" is much faster than a
+    general parser that tokenizes every line. Returns (mm, records)
+    where records is a list of (header, start, end, seqlen) with
+    start:end spanning the whole record including its header line and
+    seqlen the sequence length (record bytes minus newlines). An empty
+    data file cannot be mmapped and indexes as (None, []).
+    """
+
+    if os.path.getsize(path) == 0:
+        return None, []
+    #the mapping keeps its own reference to the file, so the handle can
+    #be closed straight away
+    with open(path, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    records = []
+    start = mm.find(b">")
+    while start != -1:
+        hdr_end = mm.find(b"\n", start)
+        if hdr_end == -1:
+            break
+        header = mm[start + 1:hdr_end].decode().rstrip("\r")
+        nxt = mm.find(b"\n>", hdr_end)
+        end = len(mm) if nxt == -1 else nxt + 1
+        seq = mm[hdr_end + 1:end]
+        seqlen = len(seq) - seq.count(b"\n") - seq.count(b"\r")
+        records.append((header, start, end, seqlen))
+        if nxt == -1:
+            break
+        start = nxt + 1
+    return mm, records
+
+def parse_input_file(input_file, sanitize=False):
+    """Read the items from the input file.
+
+    With sanitize=True each item is returned as a (raw, sanitized) tuple,
+    sanitized having "/" replaced by "-" for use in filenames - the awful
+    hack noted above, done once here rather than inside the loops. The raw
+    name is what matches the fasta headers.
+    """
 
     with open(input_file, 'r') as f:
         items = f.read().splitlines()
-    if len(items) > len(set(items)):
-        print("\tError: not all names in %s are unique")
+    #One Counter pass finds the offenders - and say which they are
+    dupes = [name for name, n in Counter(items).items() if n > 1]
+    if dupes:
+        print("\tError: not all names in %s are unique: %s" % (input_file,
+                ", ".join(dupes[:10])))
         print("\tExiting... done.")
         sys.exit()
-    else:
-        return items
+    if sanitize:
+        return [(item, item.replace("/", "-")) for item in items]
+    return items
 
 def main(datafilelist, locusnames, outdir="locus_alignments", csv_log=False, quiet=False):
     """Main loop"""
 
-    loci = parse_input_file(locusnames)
+    loci = parse_input_file(locusnames, sanitize=True)
     data = parse_input_file(datafilelist)
 
     if not quiet:
@@ -81,57 +127,74 @@ def main(datafilelist, locusnames, outdir="locus_alignments", csv_log=False, qui
         if not quiet:
             print("done")
 
-    #INDEX
-    if os.path.exists("locus.idx"):
-        os.remove("locus.idx")
+    #INDEX - mmap each data file and scan it for record byte offsets,
+    #bucketing the records by locus as we go. The locus name is everything
+    #after the first "|", and partition() gives it in a single allocation
+    #where split() builds a list
     if not quiet:
-        print("\tMaking index file... ", end='')
-    lind = SeqIO.index_db("locus.idx", data, "fasta")
+        print("\tIndexing data files... ", end='')
+    loci_set = set(locus for locus, _ in loci)
+    buckets = {}
+    mmaps = []
+    for file_idx, f in enumerate(data):
+        mm, records = index_fasta(f)
+        mmaps.append(mm)
+        for header, start, end, seqlen in records:
+            ident, _, key_locus = header.partition("|")
+            if key_locus in loci_set:
+                buckets.setdefault(key_locus, []).append((file_idx, start,
+                        end, seqlen))
     if not quiet:
         print("done")
 
+    #Stream the log rather than accumulating one formatted row per locus
+    #in memory until the end
     if csv_log:
-        clog = ["locus,#alleles,max len,min len\n"]
+        csv_fh = open("locus_log.csv", "w", buffering=1048576)
+        csv_fh.write("locus,#alleles,max len,min len\n")
 
     #Loop over each locus and write seqs to alignment file
     if not quiet:
         print("\tWriting locus files (number, and min and max lengths of alleles):")
-    for locus in loci:
+    for locus, locus_filename in loci:
         if not quiet:
             print("\t\t%-8s -> " % locus, end='')
-        locus_recs = []
-        found = False
-        for rec in lind:
-            rec_locus = rec.split("|")[1]
-            if rec_locus == locus:
-                locus_recs.append(lind[rec])
-                found = True
-        if not found:
-            print("\t Unable to find locus %s in data file %s" % (locus, rec))
-
-        #Stats
-        rec_lens = []
-        for r in locus_recs:
-            rec_lens.append(len(r))
+        spans = buckets.get(locus, [])
+        if not spans:
+            print("\t Unable to find locus %s in the data files" % locus)
+            continue
+
+        #Stats - lengths were computed during indexing, so just track the
+        #running min and max in one pass
+        min_len = max_len = spans[0][3]
+        for _, _, _, seqlen in spans:
+            if seqlen < min_len:
+                min_len = seqlen
+            elif seqlen > max_len:
+                max_len = seqlen
         if not quiet:
-            print("\t%-2i alleles (%-4i - %-4i)" % (len(locus_recs), min(rec_lens),
-                    max(rec_lens)))
+            print("\t%-2i alleles (%-4i - %-4i)" % (len(spans), min_len,
+                    max_len))
         if csv_log:
-            clog.append("%s,%i,%i,%i\n" % (locus, len(locus_recs),
-                min(rec_lens), max(rec_lens)))
-
-        ## BEWARE HACK!!! Get rid of chars causing problems with file names
-        if "/" in locus:
-            locus = locus.replace("/", "-")
-
-        SeqIO.write(locus_recs, "%s/%s.fasta" % (outdir,locus), "fasta")
+            csv_fh.write("%s,%i,%i,%i\n" % (locus, len(spans), min_len,
+                max_len))
+
+        #The records are already validly formatted fasta in the source
+        #files, so copy the raw bytes rather than round-tripping through
+        #SeqRecord parsing and re-wrapping
+        with open("%s/%s.fasta" % (outdir, locus_filename), "wb") as fh:
+            for file_idx, start, end, seqlen in spans:
+                raw = mmaps[file_idx][start:end]
+                fh.write(raw)
+                if not raw.endswith(b"\n"):
+                    fh.write(b"\n")
         sys.stdout.flush()
 
+    for mm in mmaps:
+        if mm is not None:
+            mm.close()
     if csv_log:
-        fh = open("locus_log.csv", "w")
-        for l in clog:
-            fh.write(l)
-        fh.close()
+        csv_fh.close()
     if not quiet:
         print("\n\tDone.")
 
@@ -152,18 +215,6 @@ if __name__ == "__main__":
                         help="Output directory name Default: locus_alignments",
                         default="locus_alignments"
                         )
-    parser.add_argument("-i", "--reuse_index",
-                        dest="reuse_index",
-                        help="Reuse an old index file (named locus.idx)",
-                        default=False,
-                        action='store_true'
-                        )
-    parser.add_argument("-o", "--overwrite",
-                        dest="overwrite_index",
-                        help="Overwrite index file",
-                        default=False,
-                        action='store_true'
-                        )
     parser.add_argument("-l", "--write_csv",
                         dest="csv_log",
                         help="Write a csv formatted log file",
@@ -177,5 +228,5 @@ if __name__ == "__main__":
                         action='store_true'
                         )
     args = parser.parse_args()
-    main(args.data_files, args.locus_names, args.outdir, args.reuse_index,
-            args.overwrite, args.csv_log, args.quiet)
+    main(args.data_files, args.locus_names, args.outdir, args.csv_log,
+            args.quiet)
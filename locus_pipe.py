@@ -42,6 +42,7 @@ import argparse
 import sys
 import subprocess
 import os
+import concurrent.futures
 from Bio import SeqIO
 import textwrap
 import p4
@@ -49,6 +50,7 @@ p4.var.doCheckForBlankSequences = False
 p4.var.doCheckForDuplicateSequences = False
 
 from locus_alignments_from_transcriptomes import main as write_locus_alignments
+from locus_alignments_from_transcriptomes import parse_input_file
 from TranslatorX_functions import run_TranslatorX
 from remove_gapped_and_ambiguous_codons import main as clean_loci
 
@@ -73,7 +75,152 @@ SUPERFLUOUS_TRANSX_FILES = [
 "%s_transX.nt3_cleanali.fasta"]
 ##############################################
 
-def main(data_filenames, locus_names, out_dir, write_loci=False):
+def remove_if_present(path):
+    """Remove a file, ignoring it if missing - a partial earlier run (or
+    TranslatorX failing mid-way) may not have produced every leftover,
+    and one absent file should not halt the whole pipeline"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def write_unique_sequences(locus, out_dir):
+    """Collapse identical sequences in {locus}.fasta before alignment.
+
+    Transcriptome experiments often carry identical allele sequences
+    across samples; aligning each unique sequence once and copying the
+    result back out is much cheaper than aligning the duplicates.
+
+    Returns (fasta_to_align, duplicates) where fasta_to_align is an
+    absolute path and duplicates maps each representative's name to the
+    other names sharing its sequence. When every sequence is unique the
+    original file is returned with None and no collapsed file is written.
+    """
+
+    fasta = os.path.join(out_dir, f"{locus}.fasta")
+    records = list(SeqIO.parse(fasta, "fasta"))
+    by_seq = {}
+    for rec in records:
+        by_seq.setdefault(str(rec.seq), []).append(rec)
+    if len(by_seq) == len(records):
+        return fasta, None
+
+    duplicates = {}
+    uniq_fasta = os.path.join(out_dir, f"{locus}_uniq.fasta")
+    with open(uniq_fasta, "w") as fh:
+        for recs in by_seq.values():
+            rep = recs[0]
+            fh.write(">%s\n%s\n" % (rep.description, str(rep.seq)))
+            duplicates[rep.description] = [r.description for r in recs[1:]]
+    return uniq_fasta, duplicates
+
+def expand_unique_alignment(aligned_file, duplicates):
+    """Re-expand a collapsed alignment back to the full set of sequences,
+    returning the fasta text rather than writing a file"""
+
+    chunks = []
+    seen = set()
+    for rec in SeqIO.parse(aligned_file, "fasta"):
+        seq = str(rec.seq)
+        seen.add(rec.description)
+        chunks.append(">%s\n%s\n" % (rec.description, seq))
+        for name in duplicates.get(rec.description, []):
+            chunks.append(">%s\n%s\n" % (name, seq))
+    #Every representative must come back out of TranslatorX under its
+    #original name - if mafft mangled a header the expansion would
+    #otherwise silently drop taxa from the cleaned alignment
+    missing = sorted(set(duplicates) - seen)
+    if missing:
+        raise RuntimeError("Representatives missing from %s "
+                "(headers altered by TranslatorX?): %s" % (aligned_file,
+                ", ".join(missing[:5])))
+    return "".join(chunks)
+
+def process_locus(locus, out_dir):
+    """Align one locus with TranslatorX, clean it, and remove the leftovers.
+
+    Runs in a worker process. Every path is built explicitly under
+    out_dir so nothing here depends on the working directory;
+    run_TranslatorX comes from an external module with no cwd argument,
+    so each worker still chdir's into out_dir via the pool initializer
+    for the files TranslatorX itself writes.
+    Returns the progress messages for the driver to print.
+    """
+
+    messages = []
+
+    #See if we have already done this locus - either as-is or collapsed
+    if (os.path.exists(os.path.join(out_dir, "%s_transX.mafft.log" % locus)) or
+            os.path.exists(os.path.join(out_dir,
+                    "%s_uniq_transX.mafft.log" % locus))):
+        messages.append("\tSkipping %s - already done" % locus)
+        return messages
+
+    #Check file exists and has content
+    fasta = os.path.join(out_dir, f"{locus}.fasta")
+    if not os.path.exists(fasta):
+        raise RuntimeError(f"Cannot find locus data file: {locus}.fasta")
+    if os.path.getsize(fasta) == 0:
+        raise RuntimeError(f"Locus file {locus}.fasta has 0 bytes content")
+
+    #Collapse identical sequences so TranslatorX only aligns each unique
+    #sequence once; the alignment is expanded back out below
+    align_input, duplicates = write_unique_sequences(locus, out_dir)
+    #align_input is absolute, so every %s_transX... path built from the
+    #prefix below is too
+    prefix = os.path.splitext(align_input)[0]
+    if duplicates is not None:
+        n_dups = sum(len(names) for names in duplicates.values())
+        messages.append("\tCollapsed %i duplicate sequences in %s" % (n_dups,
+                locus))
+
+    messages.append("\tAligning %s with TranslatorX " % locus)
+    returncode, stderr, stdout = run_TranslatorX(align_input, code=1, gbl="-b5=n")
+
+    if returncode != 0:
+        if b"Gblocks alignment:  0 positions" in stderr:
+            messages.append("\tGblocks alignment:  0 positions")
+        else:
+            messages.append("\tError running TranslatorX - see transX_stdout.text...")
+            messages.append("\treturncode = %s" % returncode)
+            messages.append("\tSee transX_stdout.text. Continuing...")
+            of = open(os.path.join(out_dir, "transX_stdout.text"), "a")
+            of.write(stdout)
+            of.write(stderr)
+            of.close()
+        #Remove these extra file that are not in SUPERFLUOUS_TRANSX_FILES:
+        extra_files = ["%s_transX.aa_ali.fasta-gb.htm",
+                       "%s_transX.nt_ali.fasta",
+                       "%s_transX.nt_cleanali.fasta"]
+        for f in extra_files:
+            remove_if_present(f % prefix)
+    else:
+        target_file = "%s_transX.nt_cleanali.fasta" % prefix
+        if not os.path.exists(target_file):
+            messages.append("\tCannot find %s. Continuing..." % target_file)
+            return messages
+        # Clean out all ambigous, gapped, or stop codons if present - even when
+        # not constant - by removing the codon site (3 nucs at which it occurs)
+        if duplicates is not None:
+            #Expand in memory and hand the text straight to the cleaner -
+            #no expanded alignment is written out and re-parsed
+            contents = expand_unique_alignment(target_file, duplicates)
+            clean_loci(os.path.join(out_dir,
+                    "%s_transX.nt_cleanali.fasta" % locus), quiet=True,
+                    contents=contents)
+        else:
+            clean_loci(target_file, quiet=True)
+
+    #Finally clean up these file! - including the collapsed fasta the
+    #duplicate pass wrote
+    for f in SUPERFLUOUS_TRANSX_FILES:
+        remove_if_present(f % prefix)
+    if duplicates is not None:
+        remove_if_present(align_input)
+
+    return messages
+
+def main(data_filenames, locus_names, out_dir, write_loci=False, threads=None):
 
     ## STEP 1: Write the individual locus files from the sample fasta files
     if write_loci:
@@ -82,70 +229,35 @@ def main(data_filenames, locus_names, out_dir, write_loci=False):
         print(f"\nNot writing locus data files, expecting them to be present in the", end="")
         print(f" directory '{out_dir}'\n")
 
-    ## STEP 2: Align with TranslatorX
-    f = open(locus_names, 'r')
-    loci = f.read().splitlines()
-    f.close()
-
-    os.chdir(out_dir)
-    for locus in loci:
-        sys.stdout.flush()
-
-        ## BEWARE HACK!!! Get rid of chars causing problems with file names
-        if "/" in locus:
-            locus = locus.replace("/", "-")
-
-        #See if we have already done this locus
-        if os.path.exists("%s_transX.mafft.log" % locus):
-            print("\tSkipping %s - already done" % locus)
-            continue
-
-        #Check file exists and has content
-        if not os.path.exists("%s.fasta" % locus):
-            print(f"Cannot find locus data file: {locus}.fasta. Exiting")
-            sys.exit()
-        if os.path.getsize(f"{locus}.fasta") == 0:
-            print(f"Locus file {locus}.fasta has 0 bytes content. Exiting")
-            sys.exit()
-
-        print("\tAligning %s with TranslatorX " % locus, end="")
-        returncode, stderr, stdout = run_TranslatorX(f"{locus}.fasta", code=1, gbl="-b5=n")
-        #if r[0] == "":
-        #    print("\tTranslatorX failed - perhaps cannot find input file...")
-        #    print("\n")
-        #    continue
-        #else:
-        #(returncode, stderr, stdout) = r
-
-        if returncode != 0:
-            if b"Gblocks alignment:  0 positions" in stderr:
-                print("\tGblocks alignment:  0 positions")
-            else:
-                print("\tError running TranslatorX - see transX_stdout.text...")
-                print("\treturncode = %s" % returncode)
-                print("\tSee transX_stdout.text. Continuing...")
-                of = open("transX_stdout.text", "a")
-                of.write(stdout)
-                of.write(stderr)
-                of.close()
-            #Remove these extra file that are not in SUPERFLUOUS_TRANSX_FILES:
-            extra_files = ["%s_transX.aa_ali.fasta-gb.htm",
-                           "%s_transX.nt_ali.fasta",
-                           "%s_transX.nt_cleanali.fasta"]
-            for f in extra_files:
-                os.remove(f % locus)
-        else:
-            target_file = "%s_transX.nt_cleanali.fasta" % locus
-            if not os.path.exists(target_file):
-                print("\tCannot find %s. Continuing..." % target_file)
-                continue
-            # Clean out all ambigous, gapped, or stop codons if present - even when
-            # not constant - by removing the codon site (3 nucs at which it occurs)
-            clean_loci(target_file, quiet=True)
+    ## STEP 2: Align with TranslatorX, one process per locus. The "/" to
+    ## "-" filename sanitation is done by parse_input_file, and all the
+    ## files in out_dir carry the sanitized names
+    loci = parse_input_file(locus_names, sanitize=True)
+
+    out_dir = os.path.abspath(out_dir)
+    if not threads:
+        threads = os.cpu_count()
 
-        #Finally clean up these file!
-        for f in SUPERFLUOUS_TRANSX_FILES:
-            os.remove(f % locus)
+    #Each worker chdir's into out_dir once, so the relative paths used by
+    #TranslatorX and the clean-up stay valid; printing is done only here in
+    #the driver so the messages from each locus stay together
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads,
+            initializer=os.chdir, initargs=(out_dir,)) as executor:
+        futures = {executor.submit(process_locus, locus_filename,
+                out_dir): locus for locus, locus_filename in loci}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                messages = future.result()
+            except RuntimeError as e:
+                #Cancel the queued loci before exiting - the executor's
+                #__exit__ otherwise waits for every submitted task to run
+                #to completion and the "exit" could take hours
+                executor.shutdown(wait=False, cancel_futures=True)
+                print(f"{e}. Exiting")
+                sys.exit()
+            for m in messages:
+                print(m)
+            sys.stdout.flush()
 
 
 if __name__ == "__main__":
@@ -171,5 +283,13 @@ if __name__ == "__main__":
                         default=False,
                         action='store_true'
                         )
+    parser.add_argument("-t", "--threads",
+                        dest="threads",
+                        help="Number of loci to align in parallel. " + \
+                             "Default: all cores",
+                        type=int,
+                        default=None
+                        )
     args = parser.parse_args()
-    main(args.data_filenames, args.locus_names, args.outdir, args.write_loci)
+    main(args.data_filenames, args.locus_names, args.outdir, args.write_loci,
+            args.threads)
@@ -26,63 +26,340 @@ Cymon J. Cox 6-1-2022
 """
 
 import os
+import re
 import sys
 import time
 import argparse
 import textwrap
-from p4 import *
-from p4 import geneticcode
-var.doCheckForDuplicateSequences = False
-var.doCheckForBlankSequences = False
+import functools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def read_fasta(text):
+    """A minimal fasta parser returning (taxon_names, sequences).
+
+    The pipeline only ever feeds fasta, and p4's generic parser - and
+    its module-global state - is an order of magnitude more machinery
+    than these alignments need. Sequences are lowercased, as p4 does.
+    """
+
+    names = []
+    seqs = []
+    chunks = None
+    for line in text.splitlines():
+        if line.startswith(">"):
+            if chunks is not None:
+                seqs.append("".join(chunks).lower())
+            names.append(line[1:].strip())
+            chunks = []
+        elif chunks is not None:
+            chunks.append(line.strip())
+    if chunks is not None:
+        seqs.append("".join(chunks).lower())
+    return names, seqs
+
+def read_alignment_with_p4(source):
+    """Parse a non-fasta alignment (nexus, phylip, ...) with p4.
+
+    p4 works through module-global state, so it is imported and cleaned
+    up here rather than letting it leak into the rest of the script.
+    """
+
+    import p4
+    p4.var.doCheckForDuplicateSequences = False
+    p4.var.doCheckForBlankSequences = False
+    p4.read(source)
+    a = p4.var.alignments[0]
+    names = [seq.name for seq in a.sequences]
+    seqs = [seq.sequence for seq in a.sequences]
+    #Clean up P4 vars in case it's being looped
+    p4.var.alignments = []
+    p4.var.nexusSets       = None
+    p4.var.trees           = []
+    p4.var.sequenceLists   = []
+    return names, seqs
+
+def write_nexus(fn, names, sequences):
+    """Write the cleaned alignment as a simple nexus data block"""
+
+    def nexus_name(name):
+        if re.fullmatch(r"\w+", name):
+            return name
+        return "'%s'" % name.replace("'", "''")
+
+    with open(fn, "w") as fh:
+        fh.write("#NEXUS\n\nbegin data;\n")
+        fh.write("  dimensions ntax=%i nchar=%i;\n" % (len(names),
+                len(sequences[0])))
+        fh.write("  format datatype=dna gap=- missing=?;\n")
+        fh.write("  matrix\n")
+        for name, seq in zip(names, sequences):
+            fh.write("    %s  %s\n" % (nexus_name(name), seq))
+        fh.write("  ;\nend;\n")
+
+#Byte classes for the translate() trick below: acgt -> 0, the gap
+#character -> 1, anything else -> 2 (ambiguous). Classifying a whole
+#sequence is then a single C-level bytes.translate() call
+CODON_CLASS = bytes(0 if b in b"acgt" else 1 if b == ord('-') else 2
+        for b in range(256))
+GAP_CLASS = 1
+CLEAN_CODON = b"\x00\x00\x00"
 
 def contains_ambig(codon):
-    for i in codon:
-        if i not in ["a", "c", "g", "t"]:
-            return True
-    return False
+    #gaps count as ambiguous too - anything outside acgt does
+    return codon.encode().translate(CODON_CLASS) != b"\x00" * len(codon)
 
 def contains_gap(codon):
-    for c in codon:
-        if "-" in c:
-            return True
-    return False
+    return GAP_CLASS in codon.encode().translate(CODON_CLASS)
 
 def is_stop(codon, stop_codons):
     if codon in stop_codons:
         return True
     return False
 
-def main(matrix, code=1, ambig=False, gaps=False,
-        stops=False, constant=False, quiet=False):
+@functools.lru_cache(maxsize=None)
+def stop_codon_mask(stop_codons):
+    """The stop codons packed into one 64-bit integer: with acgt encoded
+    as 0..3 each codon is a base-4 index, and bit index of the mask is set
+    when that codon is a stop. The test is then a single shift-and-mask."""
+    encode = {"a": 0, "c": 1, "g": 2, "t": 3}
+    mask = 0
+    for sc in stop_codons:
+        mask |= 1 << (encode[sc[0]]*16 + encode[sc[1]]*4 + encode[sc[2]])
+    return mask
 
+@functools.lru_cache(maxsize=None)
+def get_stop_codons(code):
+    """The stop codons of the genetic code, built once per translation
+    table - main() is called once per locus when looped from locus_pipe"""
+    from p4 import geneticcode
     c = geneticcode.GeneticCode(transl_table=code)
+    return frozenset(codon.lower() for codon in c.codonsForAA["*"])
 
-    stop_codons = c.codonsForAA["*"]
+def filter_codon_sites_numpy(sequences, stop_codons, ambig, gaps, stops,
+        constant):
+    """Classify and filter every codon site at once with NumPy.
 
-    read(matrix)
-    a = var.alignments[0]
-    if a.nChar == 0 or (a.nChar%3) != 0:
+    The whole alignment becomes one (taxa x chars) uint8 matrix and the
+    gap/ambig/stop tests become a handful of vectorized masks instead of
+    ~taxa x chars Python iterations.
+
+    Returns (valid_sequences, count, count_ambigs, count_gaps, count_stops)
+    matching what the plain Python loops produce.
+    """
+
+    n_taxa = len(sequences)
+    A = np.frombuffer("".join(sequences).encode(),
+            dtype=np.uint8).reshape(n_taxa, -1)
+    no_codons = A.shape[1] // 3
+    codons = A.reshape(n_taxa, no_codons, 3)
+
+    #As in contains_ambig(), anything outside acgt - including the gap
+    #character - counts as ambiguous
+    is_acgt = ((codons == ord('a')) | (codons == ord('c')) |
+               (codons == ord('g')) | (codons == ord('t')))
+    has_ambig = (~is_acgt).any(axis=2)
+    has_gap = (codons == ord('-')).any(axis=2)
+
+    #Encode each codon as a base-4 integer and test the matching bit of
+    #the packed stop-codon mask - a branchless shift-and-mask per codon.
+    #Codons with non-acgt characters encode to nonsense but can never be
+    #stops, so mask them out with has_ambig
+    enc = np.zeros(256, dtype=np.uint64)
+    for i, nuc in enumerate("acgt"):
+        enc[ord(nuc)] = i
+    stop_mask = np.uint64(stop_codon_mask(stop_codons))
+    idx = (enc[codons[:, :, 0]]*np.uint64(16) +
+            enc[codons[:, :, 1]]*np.uint64(4) + enc[codons[:, :, 2]])
+    has_stop = ((stop_mask >> idx) & np.uint64(1)).astype(bool) & ~has_ambig
+
+    count_ambigs = count_gaps = count_stops = 0
+    #Constant mode removes a site only when all taxa have the target,
+    #counted against the first enabled category where they all match
+    if constant:
+        removed = np.zeros(no_codons, dtype=bool)
+        if ambig:
+            site = has_ambig.all(axis=0)
+            count_ambigs = int(site.sum())
+            removed |= site
+        if gaps:
+            site = has_gap.all(axis=0) & ~removed
+            count_gaps = int(site.sum())
+            removed |= site
+        if stops:
+            site = has_stop.all(axis=0) & ~removed
+            count_stops = int(site.sum())
+            removed |= site
+    #Default mode removes a site when any taxon has a target, counted
+    #against whatever the first offending taxon (in taxon order) holds -
+    #the same attribution as the plain loops, so the printed breakdown
+    #does not depend on which code path ran
+    else:
+        offend = np.zeros(has_ambig.shape, dtype=bool)
+        if ambig:
+            offend |= has_ambig
+        if gaps:
+            offend |= has_gap
+        if stops:
+            offend |= has_stop
+        removed = offend.any(axis=0)
+        first = offend.argmax(axis=0)
+        cols = np.arange(no_codons)
+        remaining = removed.copy()
+        if ambig:
+            site = remaining & has_ambig[first, cols]
+            count_ambigs = int(site.sum())
+            remaining &= ~site
+        if gaps:
+            site = remaining & has_gap[first, cols]
+            count_gaps = int(site.sum())
+            remaining &= ~site
+        if stops:
+            count_stops = int(remaining.sum())
+
+    count = no_codons - count_ambigs - count_gaps - count_stops
+    if count == 0:
+        valid_sequences = []
+    else:
+        B = A[:, np.repeat(~removed, 3)]
+        valid_sequences = [row.tobytes().decode() for row in B]
+    return valid_sequences, count, count_ambigs, count_gaps, count_stops
+
+if njit is not None:
+    @njit(cache=True)
+    def codon_site_kernel(A, stop_mask, ambig, gaps, stops, constant):
+        """Classify every codon site of the (taxa x chars) uint8 matrix in
+        one compiled pass. Returns (kept, counts) with counts holding the
+        ambig/gap/stop removals, attributed exactly as the plain loops
+        attribute them."""
+        n_taxa, n_chars = A.shape
+        no_codons = n_chars // 3
+        kept = np.ones(no_codons, dtype=np.bool_)
+        counts = np.zeros(3, dtype=np.int64)
+        for s in range(no_codons):
+            j = s * 3
+            n_ambig = 0
+            n_gap = 0
+            n_stop = 0
+            for t in range(n_taxa):
+                c0 = A[t, j]
+                c1 = A[t, j + 1]
+                c2 = A[t, j + 2]
+                codon_ambig = False
+                codon_gap = False
+                idx = np.uint64(0)
+                for c in (c0, c1, c2):
+                    if c == 97:        # a
+                        idx = idx * np.uint64(4)
+                    elif c == 99:      # c
+                        idx = idx * np.uint64(4) + np.uint64(1)
+                    elif c == 103:     # g
+                        idx = idx * np.uint64(4) + np.uint64(2)
+                    elif c == 116:     # t
+                        idx = idx * np.uint64(4) + np.uint64(3)
+                    else:
+                        codon_ambig = True
+                        if c == 45:    # -
+                            codon_gap = True
+                codon_stop = (not codon_ambig and
+                        (stop_mask >> idx) & np.uint64(1) != 0)
+                if not constant:
+                    #the first offending codon in taxon order decides the
+                    #category, as in the plain loops
+                    if ambig and codon_ambig:
+                        counts[0] += 1
+                        kept[s] = False
+                        break
+                    if gaps and codon_gap:
+                        counts[1] += 1
+                        kept[s] = False
+                        break
+                    if stops and codon_stop:
+                        counts[2] += 1
+                        kept[s] = False
+                        break
+                else:
+                    if codon_ambig:
+                        n_ambig += 1
+                    if codon_gap:
+                        n_gap += 1
+                    if codon_stop:
+                        n_stop += 1
+            if constant:
+                if ambig and n_ambig == n_taxa:
+                    counts[0] += 1
+                    kept[s] = False
+                elif gaps and n_gap == n_taxa:
+                    counts[1] += 1
+                    kept[s] = False
+                elif stops and n_stop == n_taxa:
+                    counts[2] += 1
+                    kept[s] = False
+        return kept, counts
+
+def filter_codon_sites_numba(sequences, stop_codons, ambig, gaps, stops,
+        constant):
+    """The numba-compiled equivalent of filter_codon_sites_numpy: one
+    fused pass over the codon matrix rather than a mask per test, used
+    when numba is importable. Same return value."""
+
+    n_taxa = len(sequences)
+    A = np.frombuffer("".join(sequences).encode(),
+            dtype=np.uint8).reshape(n_taxa, -1)
+    kept, counts = codon_site_kernel(A,
+            np.uint64(stop_codon_mask(stop_codons)), ambig, gaps, stops,
+            constant)
+    count_ambigs, count_gaps, count_stops = (int(n) for n in counts)
+    count = int(kept.sum())
+    if count == 0:
+        valid_sequences = []
+    else:
+        B = A[:, np.repeat(kept, 3)]
+        valid_sequences = [row.tobytes().decode() for row in B]
+    return valid_sequences, count, count_ambigs, count_gaps, count_stops
+
+def main(matrix, code=1, ambig=False, gaps=False,
+        stops=False, constant=False, quiet=False, contents=None):
+
+    stop_codons = get_stop_codons(code)
+
+    #matrix is the alignment filename; if contents is given it is the
+    #alignment text itself, already in memory in the caller (locus_pipe),
+    #and matrix only names the output - saves writing and re-reading a file
+    if contents is not None:
+        text = contents
+    else:
+        with open(matrix) as fh:
+            text = fh.read()
+    if text.lstrip().startswith(">"):
+        taxon_names, sequences = read_fasta(text)
+    else:
+        taxon_names, sequences = read_alignment_with_p4(text)
+
+    nChar = len(sequences[0]) if sequences else 0
+    if any(len(seq) != nChar for seq in sequences):
+        print("Error: not all sequences in %s are the same length." % matrix)
+        return
+    if nChar == 0 or (nChar%3) != 0:
         print("Error: Matrix length %s is not exactly divisable by 3." %
-                a.nChar)
+                nChar)
         print("The assumption is made that the alignment is in-frame codons")
-        #Clean up P4 vars in case it's being looped
-        var.alignments = []
-        var.nexusSets       = None
-        var.trees           = []
-        var.sequenceLists   = []
         return
     else:
-        no_codons = a.nChar/3
+        no_codons = nChar/3
 
     if not quiet:
-        print("\tAlignment has %i characters and %i CODONS..." % (a.nChar,
+        print("\tAlignment has %i characters and %i CODONS..." % (nChar,
                 no_codons))
 
-    codons_by_taxon =  [[seq.sequence[i:i+3] for i in
-            range(0, len(seq.sequence), 3)] for seq in a.sequences]
-    codon_sites = zip(*codons_by_taxon)
-
-    valid_codon_sites = []
     count = 0
     count_ambigs = 0
     count_gaps   = 0
@@ -114,53 +391,79 @@ def main(matrix, code=1, ambig=False, gaps=False,
             print("\tNOT remvoving stop codons...")
         print("\tProcessing codon sites: ", end="")
 
-    #Constant
-    if not constant:
-        #remove either or gaps, ambigs, stops
-        for codon_site in codon_sites:
-            for codon in codon_site:
+    #Vectorized path - the compiled numba kernel when importable, the
+    #numpy masks otherwise
+    if np is not None:
+        filter_codon_sites = (filter_codon_sites_numba if njit is not None
+                else filter_codon_sites_numpy)
+        (valid_sequences, count, count_ambigs, count_gaps,
+                count_stops) = filter_codon_sites(sequences,
+                        stop_codons, ambig, gaps, stops, constant)
+        if not quiet:
+            print("." * count, end="")
+    #Plain Python fallback when NumPy is not available
+    else:
+        codons_by_taxon =  [[seq[i:i+3] for i in
+                range(0, len(seq), 3)] for seq in sequences]
+        codon_sites = zip(*codons_by_taxon)
+        valid_codon_sites = []
+
+        #Classify every sequence once with translate() rather than probing
+        #each codon character-by-character inside the loops
+        cls_by_taxon = [seq.encode().translate(CODON_CLASS)
+                for seq in sequences]
+        cls_codons_by_taxon = [[cls[i:i+3] for i in range(0, len(cls), 3)]
+                for cls in cls_by_taxon]
+        cls_sites = zip(*cls_codons_by_taxon)
+
+        #Constant
+        if not constant:
+            #remove either or gaps, ambigs, stops
+            for codon_site, cls_site in zip(codon_sites, cls_sites):
+                for codon, cls in zip(codon_site, cls_site):
+                    if ambig:
+                        if cls != CLEAN_CODON:
+                            count_ambigs += 1
+                            break
+                    if gaps:
+                        if GAP_CLASS in cls:
+                            count_gaps += 1
+                            break
+                    if stops:
+                        if is_stop(codon, stop_codons):
+                            count_stops += 1
+                            break
+                else:
+                    valid_codon_sites.append(codon_site)
+                    count += 1
+        #Per seq
+        else:
+            for codon_site, cls_site in zip(codon_sites, cls_sites):
                 if ambig:
-                    if contains_ambig(codon):
+                    if all(cls != CLEAN_CODON for cls in cls_site):
                         count_ambigs += 1
-                        break
+                        continue
                 if gaps:
-                    if contains_gap(codon):
+                    if all(GAP_CLASS in cls for cls in cls_site):
                         count_gaps += 1
-                        break
+                        continue
                 if stops:
-                    if is_stop(codon, stop_codons):
+                    if all(is_stop(codon, stop_codons) for codon in
+                            codon_site):
                         count_stops += 1
-                        break
-            else:
+                        continue
                 valid_codon_sites.append(codon_site)
-                if not quiet:
-                    print(".", end="")
                 count += 1
-    #Per seq
-    else:
-        for codon_site in codon_sites:
-            if ambig:
-                if [contains_ambig(codon) for codon in
-                        codon_site].count(True) == len(codon_site):
-                    count_ambigs += 1
-                    continue
-            if gaps:
-                if [contains_gap(codon) for codon in
-                        codon_site].count(True) == len(codon_site):
-                    count_gaps += 1
-                    continue
-            if stops:
-                if [is_stop(codon, stop_codons) for codon in
-                        codon_site].count(True) == len(codon_site):
-                    count_stops += 1
-                    continue
-            valid_codon_sites.append(codon_site)
-            if not quiet:
-                print(".",)
-            count += 1
+
+        #One batched write rather than one per valid site
+        if not quiet:
+            print("." * count, end="")
+
+        valid_codons_by_taxon = zip(*valid_codon_sites)
+        valid_sequences = ["".join(seq) for seq in valid_codons_by_taxon]
 
     if not quiet:
-        print
+        print()
         if ambig:
             print("\tRemoved %-3i sites containing ambiguities..." %
                     count_ambigs)
@@ -172,26 +475,15 @@ def main(matrix, code=1, ambig=False, gaps=False,
 
     counted_codons = count+count_gaps+count_ambigs+count_stops
     assert counted_codons == no_codons, "Error: not all codons counted (%i != %i)" % (counted_codons, no_codons)
-    valid_codons_by_taxon = zip(*valid_codon_sites)
-    valid_sequences = ["".join(seq) for seq in valid_codons_by_taxon]
 
     if valid_sequences == []:
         print("\tAll codon sites removed; no remaining sites - no output.")
     else:
-        for i, seq in enumerate(valid_sequences):
-            a.sequences[i].sequence = seq
-        a.checkLengthsAndTypes()
-        (filename, ext) = os.path.splitext(a.fName)
+        (filename, ext) = os.path.splitext(matrix)
         fn = filename + "_cleaned.nex"
-        a.writeNexus(fn)
+        write_nexus(fn, taxon_names, valid_sequences)
         print("\tWritten cleaned alignment (%i codons) to: %s" % \
-            (len(valid_codon_sites), fn))
-
-    #Clean up P4 vars in case it's being looped
-    var.alignments = []
-    var.nexusSets       = None
-    var.trees           = []
-    var.sequenceLists   = []
+            (count, fn))
     return
 
 if __name__ == "__main__":